@@ -3,19 +3,99 @@
 """
 
 import pandas as pd
+import argparse
+import codecs
+import contextlib
 import difflib
+import functools
+import glob
+import hashlib
+import heapq
+import inspect
+import json
+import numpy as np
+import os
+import pickle
 import yaml
 import re
+import sys
+import sqlite3
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, defaultdict
 from pandas import DataFrame
 
-PATH_TO_METRICS = 'C:\\Users\\rfakhrutdinov\\__metrics__.xlsx'
+# Путь к справочнику метрик можно задать переменной окружения SKIMTOOLS_METRICS
+PATH_TO_METRICS = os.environ.get('SKIMTOOLS_METRICS',
+                                 'C:\\Users\\rfakhrutdinov\\__metrics__.xlsx')
+
+
+class MetricsRegistry:
+    '''Allowed metrics loaded from the metrics workbook
+
+    The workbook is read once and kept in memory; a pickle sidecar next to it
+    (<path>.pkl) makes repeated loads fast. Both are invalidated when the
+    workbook's size or modification time changes.
+    '''
+    def __init__(self, path=None):
+        self.path = path or PATH_TO_METRICS
+        self.sidecar = self.path + '.pkl'
+        self._stamp = None
+        self.names = ()
+        self.metrics = frozenset()
+
+    def _current_stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self):
+        stamp = self._current_stamp()
+        if stamp == self._stamp:
+            return self
+        try:
+            with open(self.sidecar, 'rb') as f:
+                cached = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            cached = {}
+        if cached.get('stamp') == stamp:
+            names = cached['names']
+        else:
+            names = tuple(pd.read_excel(self.path).NAME.to_list())
+            try:
+                with open(self.sidecar, 'wb') as f:
+                    pickle.dump({'stamp': stamp, 'names': names}, f)
+            except OSError:
+                pass
+        self._stamp = stamp
+        self.names = names
+        self.metrics = frozenset(names)
+        return self
+
+    def __contains__(self, metric):
+        return metric in self.load().metrics
+
+
+_REGISTRIES = {}
+
+def get_registry(path=None) -> MetricsRegistry:
+    path = path or PATH_TO_METRICS
+    if path not in _REGISTRIES:
+        _REGISTRIES[path] = MetricsRegistry(path)
+    return _REGISTRIES[path].load()
+
 
 #Returns list of allowed metrics
-def get_metrics(path=PATH_TO_METRICS):
-    return pd.read_excel(path).NAME.to_list()
+def get_metrics(path=None):
+    return list(get_registry(path).names)
 
 # Returns metric values that are not included in the allowed metrics
-def get_invalid_metrics(data: pd.DataFrame, metrics: iter, column='Метрика*'):
+# By default metrics are taken from the registry at PATH_TO_METRICS
+def get_invalid_metrics(data: pd.DataFrame, metrics: iter = None, column='Метрика*'):
+    if metrics is None:
+        metrics = get_registry()
+    if isinstance(metrics, MetricsRegistry):
+        metrics = metrics.load().metrics
     m = data[column]
     return m[~m.isin(metrics)].unique()
 
@@ -102,53 +182,405 @@ COLUMN_MAPPER = {'Наименование*': 'ПОКАЗАТЕЛЬ',
 def test_import():
     print("Module sucessfully imported")
 
+
+#### Instrumentation ####
+# Example:
+# with Profiler(run='2024-05') as profiler:
+#     with profiler.file(filename):
+#         data = DataModel(open_md(filename, autodetect=True))
+#         correct_columns(data, columns)
+# profiler.summary()
+
+
+# Активный профилировщик; None - замеры выключены
+_PROFILER = None
+
+
+class Profiler:
+    '''Records every call of the instrumented stages
+
+    For each call: wall time, rows in/out and peak memory growth during the
+    call (tracemalloc, only with memory=True). Calls are grouped by run and
+    by the file set with Profiler.file().
+    '''
+    def __init__(self, run=None, memory=True):
+        self.run = run or time.strftime('%Y-%m-%d %H:%M:%S')
+        self.memory = memory
+        self.records = []
+        self.current_file = None
+        self._stack = []
+        self._previous = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _PROFILER
+        self._previous, _PROFILER = _PROFILER, self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, *exc_info):
+        global _PROFILER
+        _PROFILER = self._previous
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def file(self, filename):
+        previous, self.current_file = self.current_file, filename
+        try:
+            yield self
+        finally:
+            self.current_file = previous
+
+    def call(self, name, function, args, kvargs):
+        rows_in = next((len(arg) for arg in args
+                        if isinstance(arg, (pd.DataFrame, pd.Series))), None)
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            frame = [start, start]
+            self._stack.append(frame)
+        result, error = None, None
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kvargs)
+            return result
+        except Exception as exception:
+            error = f'{type(exception).__name__}: {exception}'
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            memory = None
+            if self.memory:
+                self._stack.pop()
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame[1])
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+                memory = (peak - frame[0]) / 2 ** 20
+            rows_out = len(result) \
+                if isinstance(result, (pd.DataFrame, pd.Series)) else None
+            self.records.append({'run': self.run, 'file': self.current_file,
+                                 'stage': name, 'seconds': seconds,
+                                 'rows_in': rows_in, 'rows_out': rows_out,
+                                 'peak_mb': memory, 'error': error})
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records,
+                            columns=['run', 'file', 'stage', 'seconds', 'rows_in',
+                                     'rows_out', 'peak_mb', 'error'])
+
+    # Итоги по стадиям: число вызовов, суммарное время, строки, пик памяти
+    def summary(self, by=('run', 'file', 'stage')) -> pd.DataFrame:
+        return self.to_frame().groupby(list(by), dropna=False, sort=False).agg(
+            calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+            rows_in=('rows_in', 'sum'), rows_out=('rows_out', 'sum'),
+            peak_mb=('peak_mb', 'max')).reset_index()
+
+    def to_json(self, filename=None):
+        records = self.to_frame().to_json(orient='records', force_ascii=False)
+        if filename:
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(records)
+        return records
+
+
+# Декоратор стадий: пока профилировщик не включен, стадия вызывается напрямую
+def instrumented(function):
+    name = function.__qualname__
+    @functools.wraps(function)
+    def wrapper(*args, **kvargs):
+        if _PROFILER is None:
+            return function(*args, **kvargs)
+        return _PROFILER.call(name, function, args, kvargs)
+    return wrapper
+
+
+# Замеры в пределах файла, если профилировщик включен
+def profile_file(filename):
+    if _PROFILER is None:
+        return contextlib.nullcontext()
+    return _PROFILER.file(filename)
+
+_CALCULATED_TYPE = re.compile('((Д|д)оля|отклонение)')
+
 def define_type(x):
-    if re.search('((Д|д)оля|отклонение)', x):
+    if _CALCULATED_TYPE.search(x):
         return 'расчетный'
     return 'первичный'
 
 
+# Кэш результатов поэлементных функций: {функция: {значение: результат}}.
+# Живет весь процесс, поэтому переиспользуется между файлами
+_CLASSIFIED = defaultdict(dict)
+
+# Применяет поэлементную функцию к колонке: функция вызывается
+# только для различных значений, результат раскладывается обратно по строкам
+def classify_column(values: pd.Series, function) -> pd.Series:
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    cache = _CLASSIFIED[function]
+    results = np.empty(len(uniques), dtype=object)
+    for position, value in enumerate(uniques):
+        # NaN не равен сам себе и в кэше не находится - считаем без кэша
+        if pd.isna(value):
+            results[position] = function(value)
+            continue
+        if value not in cache:
+            cache[value] = function(value)
+        results[position] = cache[value]
+    return pd.Series(results[codes], index=values.index, name=values.name)
+
+
+def define_type_column(values: pd.Series) -> pd.Series:
+    return classify_column(values, define_type)
+
+
 
 #### Data models opening and usage ####
 
 
 # opening datamodel with specified params
 # Example:
-# data = open_md(filename, **guess_params(filename, open_md, options_set))
-def open_md(filename, *args, **kvargs):
+# data = open_md(filename, **guess_params(filename))
+# or, detecting params and parsing the file only once:
+# data = open_md(filename, autodetect=True)
+# With chunksize the datamodel is streamed: a generator of chunks is returned
+# data = open_md(filename, autodetect=True, chunksize=100_000)
+@instrumented
+def open_md(filename, *args, autodetect=False, **kvargs):
+    if autodetect:
+        kvargs = {**(guess_params(filename) or {}), **kvargs}
+    if kvargs.get('chunksize'):
+        return _iter_md(pd.read_csv(filename, *args, **kvargs))
     return pd.read_csv(filename, *args, **kvargs).dropna(how='all')
 
 
-# Guessing params (sep, encoding) in order to properly open datamodel
-def guess_params(filename, opening_function=open_md, options_set=[
-                                                          {}, 
-                                                          {'sep':';'}, 
-                                                          {'sep':';', 'encoding':'cp1251'}, 
-                                                          {'encoding':'cp1251'}
-                                                          ]):
-                                                          # most of the params
-                                                          # are included in the set
-    for options in options_set:
+def _iter_md(reader):
+    with reader:
+        for chunk in reader:
+            yield chunk.dropna(how='all')
+
+
+# Сколько байт/строк читаем с начала файла, чтобы определить параметры
+SNIFF_BYTES = 64 * 1024
+SNIFF_ROWS = 100
+SNIFF_DELIMITERS = [';', ',', '\t', '|']
+
+# Кэш определенных параметров: путь + размер + время изменения -> параметры.
+# Хранится не больше PARAMS_CACHE_SIZE последних записей
+PARAMS_CACHE = os.path.join(os.path.expanduser('~'), '.skimtools_params.json')
+PARAMS_CACHE_SIZE = 1000
+
+
+# Определяем кодировку (utf-8, utf-8 с BOM, cp1251) и разделитель
+# по первым nbytes байтам файла
+def sniff_params(filename, nbytes=SNIFF_BYTES) -> dict:
+    with open(filename, 'rb') as f:
+        head = f.read(nbytes)
+    if head.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
         try:
-            opening_function(filename, **options)
-            return options
-        except:
-            pass
+            head.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError as error:
+            # многобайтный символ мог обрезаться на границе прочитанного
+            truncated = error.reason == 'unexpected end of data'
+            encoding = 'utf-8' if truncated else 'cp1251'
+    header = head.decode(encoding, errors='ignore').splitlines()
+    header = header[0] if header else ''
+    sep = max(SNIFF_DELIMITERS, key=header.count)
+    options = {}
+    if header.count(sep) and sep != ',':
+        options['sep'] = sep
+    if encoding != 'utf-8':
+        options['encoding'] = encoding
+    return options
+
+
+def _params_cache_key(filename):
+    stat = os.stat(filename)
+    return f'{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}'
+
+
+def _read_params_cache(cache):
+    try:
+        with open(cache, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_params_cache(cache, params):
+    temporal_name = f'{cache}.{os.getpid()}.tmp'
+    with open(temporal_name, 'w', encoding='utf-8') as f:
+        json.dump(params, f, ensure_ascii=False)
+    os.replace(temporal_name, cache)
+
+
+# Guessing params (sep, encoding) in order to properly open datamodel.
+# By default params are sniffed from the beginning of the file;
+# options_set keeps the old behaviour of trying option sets one by one
+# (only the first SNIFF_ROWS rows are parsed).
+# Sniffed results are cached on disk until the file changes, cache=None
+# disables it; results of a custom options_set are never cached.
+@instrumented
+def guess_params(filename, opening_function=open_md, options_set=None,
+                 cache=PARAMS_CACHE):
+    if options_set is not None:
+        cache = None
+    key = _params_cache_key(filename)
+    cached = _read_params_cache(cache) if cache else {}
+    if key in cached:
+        return cached[key]
+    if options_set is None:
+        options = sniff_params(filename)
+    else:
+        options = None
+        # пробное чтение первых строк только там, где известно, что nrows
+        # поддерживается; свой opening_function читает файл целиком
+        sniff = {'nrows': SNIFF_ROWS} \
+            if opening_function in (open_md, pd.read_csv) else {}
+        for candidate in options_set:
+            try:
+                opening_function(filename, **sniff, **candidate)
+            except (UnicodeDecodeError, pd.errors.ParserError):
+                continue
+            options = candidate
+            break
+    if cache and options is not None:
+        # убираем прошлые версии этого файла и удаленные файлы
+        path = os.path.abspath(filename)
+        cached = {cached_key: value for cached_key, value in cached.items()
+                  if cached_key.rsplit('|', 2)[0] != path
+                  and os.path.exists(cached_key.rsplit('|', 2)[0])}
+        cached[key] = options
+        cached = dict(list(cached.items())[-PARAMS_CACHE_SIZE:])
+        _write_params_cache(cache, cached)
+    return options
 
 
 #### parsing and transforming datamodel ####
 
 
 
+class FuzzyMatcher:
+    '''Fuzzy matcher over a reference dictionary
+
+    The dictionary is indexed once by characters with their multiplicity:
+    for every (character, j) the positions of values that contain the
+    character at least j times. For a query this gives, for all values at
+    once, the number of shared characters - the bound difflib uses in
+    quick_ratio. Values whose bound is below cutoff are skipped without
+    scoring, the rest are scored with difflib.SequenceMatcher from the
+    highest bound down until no remaining value can enter the top k.
+    Results, scores and ordering are the same as difflib.get_close_matches.
+    Results are cached per queried value.
+    '''
+    def __init__(self, reference):
+        self.reference = list(dict.fromkeys(reference))
+        self._exact = set(self.reference)
+        self._lengths = np.array([len(value) for value in self.reference])
+        postings = defaultdict(list)
+        for position, value in enumerate(self.reference):
+            for char, count in Counter(value).items():
+                for j in range(1, count + 1):
+                    postings[char, j].append(position)
+        self._postings = {key: np.array(positions, dtype=np.int32)
+                          for key, positions in postings.items()}
+        self._cache = {}
+
+    # Верхняя оценка ratio для каждого значения справочника
+    def _bounds(self, value):
+        arrays = [self._postings[char, j]
+                  for char, count in Counter(value).items()
+                  for j in range(1, count + 1)
+                  if (char, j) in self._postings]
+        if arrays:
+            shared = np.bincount(np.concatenate(arrays),
+                                 minlength=len(self.reference))
+        else:
+            shared = np.zeros(len(self.reference), dtype=np.int64)
+        total = len(value) + self._lengths
+        # две пустые строки difflib считает совпадающими полностью
+        return np.divide(2.0 * shared, total,
+                         out=np.ones(len(self.reference)), where=total > 0)
+
+    # Возвращает до k пар (значение справочника, оценка) с оценкой не ниже cutoff
+    def match(self, value, k=1, cutoff=0.6):
+        key = (value, k, cutoff)
+        if key not in self._cache:
+            if k == 1 and value in self._exact:
+                best = [(1.0, value)]
+            else:
+                best = self._score(value, k, cutoff)
+            self._cache[key] = [(candidate, score) for score, candidate
+                                in sorted(best, reverse=True)]
+        return self._cache[key]
+
+    def _score(self, value, k, cutoff):
+        bounds = self._bounds(value)
+        candidates = np.flatnonzero(bounds >= cutoff)
+        candidates = candidates[np.argsort(-bounds[candidates], kind='stable')]
+        s = difflib.SequenceMatcher()
+        s.set_seq2(value)
+        best = []
+        for position in candidates:
+            # ratio не больше оценки, дальше оценки только меньше
+            if len(best) == k and best[0][0] > bounds[position]:
+                break
+            candidate = self.reference[position]
+            s.set_seq1(candidate)
+            score = s.ratio()
+            if score >= cutoff:
+                if len(best) < k:
+                    heapq.heappush(best, (score, candidate))
+                else:
+                    heapq.heappushpop(best, (score, candidate))
+        return best
+
+    # Лучшее совпадение или 'not_found'
+    def best(self, value, cutoff=0.6):
+        found = self.match(value, k=1, cutoff=cutoff)
+        return found[0][0] if found else 'not_found'
+
+    # Маппинг пачки значений: {значение: лучшее совпадение или 'not_found'}
+    def map(self, values, cutoff=0.6):
+        return {value: self.best(value, cutoff) for value in values}
+
+    # Топ-k совпадений с оценками для пачки значений
+    def match_many(self, values, k=1, cutoff=0.6) -> pd.DataFrame:
+        rows = [(value, rank, candidate, score)
+                for value in values
+                for rank, (candidate, score)
+                in enumerate(self.match(value, k, cutoff), start=1)]
+        return pd.DataFrame(rows, columns=['value', 'rank', 'match', 'score'])
+
+
+# Индексы строятся один раз на каждый справочник
+_MATCHERS = {}
+
+def get_matcher(reference):
+    key = tuple(reference)
+    if key not in _MATCHERS:
+        _MATCHERS[key] = FuzzyMatcher(key)
+    return _MATCHERS[key]
+
+
 # Задача: в столбце могут быть значения с ошибками
 # Необходимо смапить их на эталонный справочник
 # Ищем похожие значения для справочника
-def map_attribute(from_skim, from_dict):
-    return {item: 
-            difflib.get_close_matches(item, from_dict)[0] 
-            if difflib.get_close_matches(item, from_dict) != [] 
-            else 'not_found'
-            for item in from_skim}
+@instrumented
+def map_attribute(from_skim, from_dict, cutoff=0.6):
+    if not isinstance(from_dict, FuzzyMatcher):
+        from_dict = get_matcher(from_dict)
+    return from_dict.map(from_skim, cutoff)
 
 
 # Собираем все уникальные значения в столбце исходной модели данных
@@ -156,10 +588,16 @@ def get_set_attribute(dataframe, colname):
     return dataframe[colname].dropna().unique()
 
 # Возвращает индекс формы отчетности (БЦ-БЦ) из строки
+_FORM_NAME = re.compile(r'[А-Яа-я0-9]+-[А-Яа-я0-9]+|[С|с]правка №*\d+')
+
 def get_form_names(x):
     if pd.isna(x):
         return ''
-    return ', '.join(re.findall('[А-Яа-я0-9]+-[А-Яа-я0-9]+|[С|с]правка №*\d+', x))
+    return ', '.join(_FORM_NAME.findall(x))
+
+
+def get_form_names_column(values: pd.Series) -> pd.Series:
+    return classify_column(values, get_form_names)
 
 
 # Чтобы не перезаписывать случайно файлы с конфигами, заведем декоратор, 
@@ -176,7 +614,12 @@ def doublecheck(function):
 
 # hash column name for writing yaml file
 def hash_name(x):
-    return re.sub(r'\W+', '', column)
+    return re.sub(r'\W+', '', x)
+
+
+# C-реализации загрузчика и выгрузчика yaml, если PyYAML собран с libyaml
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
 
 
 # Запись файлов с параметрами
@@ -186,53 +629,169 @@ def write_yaml(filename, obj):
     with open(filename, 'w+') as f:
         yaml.dump(obj, 
                   f, 
+                  Dumper=YamlDumper,
                   allow_unicode=True, 
                   encoding='utf-8')
 
 
 def read_yaml(filename):
     with open(filename, 'r') as f: # optional: encoding='utf-8'
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=YamlLoader)
+
+
+MAPPING_STORE = 'skim_mappings.sqlite'
+
+
+class MappingStore:
+    '''Mappers of all columns and versions in a single SQLite file
+
+    Replaces the one-yaml-per-column files: mappers are read from one place,
+    merged incrementally without the overwrite prompt and cached in memory.
+    For manual editing a version can be exported to yaml and imported back.
+    '''
+    def __init__(self, path=MAPPING_STORE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS mappings ('
+            'version TEXT, column_name TEXT, value, target, '
+            'PRIMARY KEY (version, column_name, value))')
+        self._cache = {}
+
+    def columns(self, version='current'):
+        return [row[0] for row in self.connection.execute(
+            'SELECT DISTINCT column_name FROM mappings WHERE version = ?',
+            (version,))]
+
+    # Маппер колонки: {значение: исправленное значение}
+    def get(self, column, version='current') -> dict:
+        if (column, version) not in self._cache:
+            self._cache[column, version] = dict(self.connection.execute(
+                'SELECT value, target FROM mappings '
+                'WHERE version = ? AND column_name = ?',
+                (version, column)))
+        return self._cache[column, version]
+
+    def _write(self, query, column, mapper, version):
+        with self.connection:
+            cursor = self.connection.executemany(
+                query,
+                ((version, column, value, target)
+                 for value, target in mapper.items()))
+        self._cache.pop((column, version), None)
+        return cursor.rowcount
+
+    # Добавляет только новые значения, существующие не трогает.
+    # Возвращает число добавленных значений
+    def merge(self, column, mapper: dict, version='current') -> int:
+        return self._write('INSERT OR IGNORE INTO mappings VALUES (?, ?, ?, ?)',
+                           column, mapper, version)
+
+    # Перезаписывает значения маппера
+    def update(self, column, mapper: dict, version='current') -> int:
+        return self._write('INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?)',
+                           column, mapper, version)
+
+    def delete(self, column, version='current'):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM mappings WHERE version = ? AND column_name = ?',
+                (version, column))
+        self._cache.pop((column, version), None)
+
+    # yaml вида {колонка: {значение: исправленное значение}}, без doublecheck:
+    # экспорт вызывают из скриптов, где спросить подтверждение некого
+    def export_yaml(self, filename, version='current'):
+        with open(filename, 'w', encoding='utf-8') as f:
+            yaml.dump({column: self.get(column, version)
+                       for column in self.columns(version)},
+                      f, Dumper=YamlDumper, allow_unicode=True)
+
+    def import_yaml(self, filename, version='current'):
+        for column, mapper in read_yaml(filename).items():
+            self.update(column, mapper, version)
+
+    def close(self):
+        self.connection.close()
 
 
 # Write a mapper
-def mapper(datamodel, column_name, plausible_mapper):
+@instrumented
+def mapper(datamodel, column_name, plausible_mapper, cutoff=0.6):
     return map_attribute(
         get_set_attribute(datamodel,
                           column_name),
-        plausible_mapper)
+        plausible_mapper,
+        cutoff)
 
 
 # ИСправление колонки в соответствии с заданным маппером
+# (значения, которых нет в маппере, остаются как есть)
+@instrumented
 def correct_column(df, column, na_filler, mapper):
-    return df[column].fillna(na_filler).replace(mapper)
+    values = df[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(object)
+    values = values.fillna(na_filler)
+    mapped = values.map(mapper)
+    return mapped.where(mapped.notna(), values)
+
+
+NEW_FLAG = '_________________________________________###NEW!!!###'
 
 # Write a set of values for given columns
 # If you update yaml (there is an earlier version of mapping), then 
 # you should leave the update_true as true. 
 def write_sets(data: pd.DataFrame, 
                columns: iter, 
-               update_mode=True) -> None:
+               update_mode=True,
+               references=None,
+               cutoff=0.6,
+               store=None) -> None:
     '''Write a set of values for given columns
 
     If you update yaml (there is an earlier version of mapping), then 
     you should leave the update_mode as true.  
+    references optionally maps a column to its reference dictionary;
+    new values of that column are then prefilled with the closest
+    reference value (or 'not_found').
+    With a MappingStore new values are merged into the store
+    instead of per-column yaml files.
     '''
+    references = references or {}
     for column in columns:
+        new_values = get_set_attribute(data, column)
+        if store is not None and update_mode:
+            known = store.get(column)
+            new_values = [i for i in new_values if i not in known]
+        if column in references:
+            proposed = map_attribute(new_values, references[column], cutoff)
+        else:
+            proposed = {i: i for i in new_values}
+        new_mapping = {i: proposed[i] + NEW_FLAG for i in new_values}
+        if store is not None:
+            if not update_mode:
+                store.delete(column)
+            store.merge(column, new_mapping)
+            continue
         if update_mode:
             existing_yaml = read_yaml(hash_name(column) + '.yaml')
         else:
             existing_yaml = {}
-        new_flag = '_________________________________________###NEW!!!###'
-        values={**{i:i + new_flag for i in get_set_attribute(data, column)}, 
+        values={**new_mapping, 
                 **existing_yaml} 
         write_yaml(hash_name(column) + '.yaml', values)
 
 # After you manually correct written yamls with mappings, you should map columns. 
-def correct_columns(data: pd.DataFrame, columns: list) -> None:
+# With a MappingStore mappers are taken from the store instead of yaml files
+@instrumented
+def correct_columns(data: pd.DataFrame, columns: list,
+                    store=None, version='current') -> None:
     for column in columns:
-        filename = hash_name(column) + '.yaml'
-        mapper = read_yaml(filename)
+        if store is not None:
+            mapper = store.get(column, version)
+        else:
+            mapper = read_yaml(hash_name(column) + '.yaml')
         print(f'fixing column {column}')
         data[column] = correct_column(data, 
                                     column=column, 
@@ -252,73 +811,198 @@ def extract_dt(x: str) -> str:
         return 'расследованный'
     return 'Не задан'
 
+
+def extract_dt_column(values: pd.Series) -> pd.Series:
+    return classify_column(values, extract_dt)
+
+# Правила исправления значений. Правило читается так:
+# если column == equals и match_column оканчивается на suffix
+# (или содержит regex), то column = value.
+# column и match_column можно не указывать - тогда берутся колонки,
+# переданные в apply_rules. Правила применяются по порядку.
+DEVIATION_RULES = [
+    {'equals': 'Относительное отклонение (скорректировать)', 'suffix': '_fp',
+     'value': 'Относительное отклонение факта от плана'},
+    {'equals': 'Относительное отклонение (скорректировать)', 'suffix': '_ff',
+     'value': 'Относительное отклонение факта от факта прошлого года'},
+    {'equals': 'Абсолютное отклонение (скорректировать)', 'suffix': '_afp',
+     'value': 'Абсолютное отклонение факта от плана'},
+    {'equals': 'Абсолютное отклонение (скорректировать)', 'suffix': '_aff',
+     'value': 'Абсолютное отклонение факта от факта прошлого года'},
+]
+
+
+# Правила из yaml-файла: список словарей с ключами как в DEVIATION_RULES
+def load_rules(filename):
+    return read_yaml(filename)
+
+
+# Маска строк, к которым применяется правило
+def rule_mask(data, rule, column=None, match_column=None):
+    column = rule.get('column', column)
+    match_column = rule.get('match_column', match_column)
+    mask = (data[column] == rule['equals']) & data[match_column].notna()
+    values = data[match_column].astype(str)
+    if 'suffix' in rule:
+        mask &= values.str.endswith(rule['suffix'])
+    if 'regex' in rule:
+        mask &= values.str.contains(rule['regex'], regex=True)
+    return mask
+
+
+# Применяет правила к data (изменяет data), возвращает
+# количество строк, исправленных каждым правилом
+def apply_rules(data, rules, column=None, match_column=None) -> dict:
+    counts = {}
+    for position, rule in enumerate(rules):
+        mask = rule_mask(data, rule, column, match_column)
+        target = rule.get('column', column)
+        if isinstance(data[target].dtype, pd.CategoricalDtype) and \
+           rule['value'] not in data[target].cat.categories:
+            data[target] = data[target].cat.add_categories([rule['value']])
+        data.loc[mask, target] = rule['value']
+        name = rule.get('name', f"{position}: {rule['value']}")
+        counts[name] = int(mask.sum())
+    return counts
+
+
 # Analyzing VAR postfixes in accordance with business logic
-def fixing_deviations_based_on_var(data, var_column, metrics_column):
-    for i in range(len(data[metrics_column])):
-        if data[metrics_column][i] == 'Относительное отклонение (скорректировать)':
-            if data[var_column][i].endswith('_fp'):
-                data[metrics_column][i] = 'Относительное отклонение факта от плана'
-            elif data[var_column][i].endswith('_ff'):
-                data[metrics_column][i] = 'Относительное отклонение факта от факта прошлого года'
-        if data[metrics_column][i] == 'Абсолютное отклонение (скорректировать)':
-            if data[var_column][i].endswith('_afp'):
-                data[metrics_column][i] = 'Абсолютное отклонение факта от плана'
-            elif data[var_column][i].endswith('_aff'):
-                data[metrics_column][i] = 'Абсолютное отклонение факта от факта прошлого года'
+@instrumented
+def fixing_deviations_based_on_var(data, var_column, metrics_column,
+                                   rules=DEVIATION_RULES):
+    return apply_rules(data, rules, column=metrics_column,
+                       match_column=var_column)
+
+
+# Эталонный справочник в формате csv, одна колонка -> множество значений.
+# Справочник читается один раз, пока файл не изменился
+_REFERENCES = {}
+
+def read_reference(dictionary_filename,
+                   reader_options={'encoding': 'utf-8',
+                                   'sep': ';'}) -> frozenset:
+    key = (_params_cache_key(dictionary_filename),
+           tuple(sorted(reader_options.items())))
+    if key not in _REFERENCES:
+        reference = pd.read_csv(dictionary_filename, **reader_options)
+        _REFERENCES[key] = frozenset(reference.iloc[:, 0])
+    return _REFERENCES[key]
 
 
 # проверка того, есть ли значения в эталонном справочнике.
 # Справочник должен быть в формате csv, одна колонка
+@instrumented
 def dictionary_check(dataframe,
                      column,
                      dictionary_filename,
                      filename=None,
                      reader_options={'encoding': 'utf-8',
                                      'sep': ';'}):
-    collection = get_set_attribute(dataframe, column)
-    dic = list(pd.read_csv(dictionary_filename, **reader_options).squeeze())
+    collection = pd.Series(get_set_attribute(dataframe, column))
+    dic = read_reference(dictionary_filename, reader_options)
+    result = dict(zip(collection, collection.isin(dic)))
     if filename:
+        write_yaml(filename, result)
+    return result
+
+
+# Проверка сразу нескольких колонок по эталонным справочникам.
+# references: {колонка: имя csv-файла или набор допустимых значений}
+# Возвращает таблицу недопустимых значений: колонка, значение,
+# число строк и позиции строк. filename - куда сохранить отчет (csv или yaml)
+@instrumented
+def validate_columns(dataframe: pd.DataFrame,
+                     references: dict,
+                     filename=None,
+                     reader_options={'encoding': 'utf-8',
+                                     'sep': ';'}) -> pd.DataFrame:
+    reports = []
+    for column, reference in references.items():
+        if isinstance(reference, str):
+            reference = read_reference(reference, reader_options)
+        values = dataframe[column]
+        invalid = values.notna().to_numpy() & ~values.isin(reference).to_numpy()
+        positions = pd.Series(np.flatnonzero(invalid))
+        grouped = positions.groupby(values.to_numpy()[invalid], sort=False)
+        report = grouped.agg(['count', list]).rename(columns={'list': 'rows'})
+        reports.append(report.rename_axis('value').reset_index()
+                             .assign(column=column))
+    columns = ['column', 'value', 'count', 'rows']
+    report = pd.concat(reports, ignore_index=True)[columns] if reports \
+        else pd.DataFrame(columns=columns)
+    if filename and filename.endswith('.csv'):
+        report.to_csv(filename, index=False)
+    elif filename:
         write_yaml(filename,
-                   {i: True if i in dic else False for i in collection})
-    return {i: True if i in dic else False for i in collection}
+                   {column: {row.value: {'count': int(row.count),
+                                         'rows': [int(i) for i in row.rows]}
+                             for row in group.itertuples()}
+                    for column, group in report.groupby('column', sort=False)})
+    return report
 
-def split_rows_by_comma(dataframe, column):
-    result = dataframe.copy()
-    for i in range(len(dataframe)): 
-        try:
-            multiplier = result.loc[i,column].split(',')
-        except AttributeError:
-            print(result.loc[i,column])
-            continue
-        if len(multiplier) > 1:
-            current_row = result.loc[i, :].copy()
-            for case in multiplier:
-                new_row = current_row.copy()
-                new_row[column] = case
-                result.loc[len(result)] = new_row
-    result = result[~result[column].str.contains(',')]
+
+# Разворачивает строки по разделителю в заданных колонках за один проход.
+# Строка с несколькими значениями заменяется строками по одному значению
+# на каждое (по нескольким колонкам - все сочетания), порядок строк сохраняется.
+# source_column - колонка, в которую записывается индекс исходной строки
+@instrumented
+def split_rows(dataframe: pd.DataFrame,
+               columns,
+               sep=',',
+               strip=False,
+               drop_duplicates=False,
+               source_column=None) -> pd.DataFrame:
+    if isinstance(columns, str):
+        columns = [columns]
+    source = '__source_row__'
+    result = dataframe.assign(**{source: dataframe.index})
+    for column in columns:
+        values = result[column]
+        parts = values.str.split(sep, regex=False)
+        # нестроковые значения оставляем как есть
+        parts = parts.where(parts.notna(), values)
+        result = result.assign(**{column: parts}).explode(column)
+        if strip:
+            stripped = result[column].str.strip()
+            result[column] = stripped.where(stripped.notna(), result[column])
+    if drop_duplicates:
+        result = result.drop_duplicates(subset=[source, *columns])
     result.index = np.arange(len(result))
-    return result
+    if source_column:
+        return result.rename(columns={source: source_column})
+    return result.drop(columns=source)
 
-def fix_agg_result(dataframe, column):
-    result = dataframe.copy()
-    for i in range(len(result)):
-        multiplier = result.loc[i, column].split('/')
-        if len(multiplier) > 1:
-            current_row = result.loc[i, :].copy()
-            try:
-                first_part = re.search('.+?(?=[а-яА-я]+$)', multiplier[0]).group(0)
-            except AttributeError:
-                continue
-            new_row = current_row.copy()
-            new_row[column] = multiplier[0]
-            result.loc[len(result)] = new_row
-            for period in multiplier[1:]:
-                new_value = first_part + period
-                new_row = current_row.copy()
-                new_row[column] = new_value
-                result.loc[len(result)] = new_row
-    result = result[~result[column].str.contains('/')]
+
+@instrumented
+def split_rows_by_comma(dataframe, column):
+    return split_rows(dataframe, column, sep=',')
+
+# Префикс значения до последнего слова: "нарастающий итог по месяцам" -> "нарастающий итог по "
+_PERIOD_PREFIX = re.compile('.+?(?=[а-яА-я]+$)')
+
+# "итог по суткам/неделям/месяцам" -> ["итог по суткам", "итог по неделям", "итог по месяцам"]
+# Пустой список - значение не удалось разобрать, такие строки отбрасываются
+def expand_period(x, sep='/'):
+    if not isinstance(x, str):
+        return [x]
+    multiplier = x.split(sep)
+    if len(multiplier) == 1:
+        return [x]
+    first_part = _PERIOD_PREFIX.search(multiplier[0])
+    if first_part is None:
+        return []
+    return [multiplier[0]] + [first_part.group(0) + period
+                              for period in multiplier[1:]]
+
+
+@instrumented
+def fix_agg_result(dataframe, column, sep='/'):
+    values = dataframe[column].astype(object)
+    expansion = {value: expand_period(value, sep) for value in values.unique()}
+    parts = values.map(expansion)
+    result = dataframe.assign(**{column: parts})[parts.str.len() > 0]
+    result = result.explode(column)
+    result.index = np.arange(len(result))
     return result
 
 def compare_name(iterable, val, function):
@@ -326,26 +1010,325 @@ def compare_name(iterable, val, function):
         if function(i) == val:
             return i
 
+IMPORTER_HEADER = 'Пустая строка для импортера'
+IMPORTER_HEADER_ROWS = 5
+
 # Adding header for importer
+# (for writing big models see export_md - it does not copy the model)
+@instrumented
 def add_header(data):
     header = pd.DataFrame(columns=data.columns)
     for column in header.columns:
-        header[column] = pd.Series(['Пустая строка для импортера']*5)
+        header[column] = pd.Series([IMPORTER_HEADER]*IMPORTER_HEADER_ROWS)
     return pd.concat([header, data])
         
 
 
+#### Streaming datamodels ####
+# Стадии - функции, которые принимают поток чанков и возвращают поток чанков.
+# Example:
+# chunks = open_md(filename, autodetect=True, chunksize=100_000)
+# chunks = run_pipeline(chunks,
+#                       stage(DataModel),
+#                       stage(DataModel.filter_functional_and_territorial_dicts),
+#                       correct_stage({'Метрика*': 'Метрика.yaml'}),
+#                       map_stage('Наименование*', define_type, target='Тип*'))
+# write_chunks(chunks, 'result.csv', encoding='utf-8-sig')
+
+
+# Стадия из функции DataFrame -> DataFrame
+def stage(function, *args, **kvargs):
+    def run(chunks):
+        for chunk in chunks:
+            yield function(chunk, *args, **kvargs)
+    return run
+
+
+# Поэлементная функция (define_type, extract_dt, get_form_names) над колонкой,
+# результат пишется в target (по умолчанию в ту же колонку)
+def map_stage(column, function, target=None):
+    def run(chunks):
+        for chunk in chunks:
+            chunk[target or column] = classify_column(chunk[column], function)
+            yield chunk
+    return run
+
+
+# Исправление колонок по мапперам: {колонка: словарь или имя yaml-файла}.
+# yaml-файлы читаются один раз, а не на каждый чанк
+def correct_stage(mappers, na_filler=''):
+    mappers = {column: read_yaml(mapper) if isinstance(mapper, str) else mapper
+               for column, mapper in mappers.items()}
+    def run(chunks):
+        for chunk in chunks:
+            for column, mapper in mappers.items():
+                chunk[column] = correct_column(chunk, column, na_filler, mapper)
+            yield chunk
+    return run
+
+
+def run_pipeline(chunks, *stages):
+    for current_stage in stages:
+        chunks = current_stage(chunks)
+    return chunks
+
+
+# Пишет поток чанков в один csv по мере поступления, возвращает число строк
+def write_chunks(chunks, filename, encoding='utf-8', **kvargs) -> int:
+    rows = 0
+    with open(filename, 'w', encoding=encoding, newline='') as f:
+        for position, chunk in enumerate(chunks):
+            chunk.to_csv(f, header=position == 0, index=False, **kvargs)
+            rows += len(chunk)
+    return rows
+
+
+def _iter_export_chunks(data, chunksize):
+    if isinstance(data, pd.DataFrame):
+        for start in range(0, max(len(data), 1), chunksize):
+            yield data.iloc[start:start + chunksize]
+    else:
+        yield from data
+
+
+def _export_csv(chunks, f, header_rows, **kvargs):
+    rows = 0
+    for position, chunk in enumerate(chunks):
+        if position == 0:
+            pd.DataFrame([[IMPORTER_HEADER] * len(chunk.columns)] * header_rows,
+                         columns=chunk.columns).to_csv(f, index=False, **kvargs)
+        chunk.to_csv(f, header=False, index=False, **kvargs)
+        rows += len(chunk)
+    return rows
+
+
+def _export_xlsx(chunks, filename, header_rows):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    rows = 0
+    for position, chunk in enumerate(chunks):
+        if position == 0:
+            sheet.append(list(chunk.columns))
+            for _ in range(header_rows):
+                sheet.append([IMPORTER_HEADER] * len(chunk.columns))
+        values = chunk.astype(object)
+        for row in values.where(values.notna(), None).itertuples(index=False,
+                                                                 name=None):
+            sheet.append(row)
+        rows += len(chunk)
+    workbook.save(filename)
+    return rows
+
+
+# Выгрузка для импортера: строка с названиями колонок, пять пустых строк
+# для импортера и сама модель, по chunksize строк за раз, без копии модели.
+# data - DataFrame или поток чанков (см. run_pipeline).
+# Формат по расширению: .csv или .xlsx (openpyxl, write-only режим).
+# Файл пишется через временный, возвращается число строк и скорость
+@instrumented
+def export_md(data, filename, encoding='utf-8-sig', chunksize=50_000,
+              header_rows=IMPORTER_HEADER_ROWS, errors='strict', **kvargs) -> dict:
+    started = time.perf_counter()
+    temporal_name = f'{filename}.{os.getpid()}.tmp'
+    chunks = _iter_export_chunks(data, chunksize)
+    try:
+        if filename.endswith('.xlsx'):
+            rows = _export_xlsx(chunks, temporal_name, header_rows)
+        else:
+            with open(temporal_name, 'w', encoding=encoding, errors=errors,
+                      newline='') as f:
+                rows = _export_csv(chunks, f, header_rows, **kvargs)
+        os.replace(temporal_name, filename)
+    finally:
+        if os.path.exists(temporal_name):
+            os.remove(temporal_name)
+    seconds = time.perf_counter() - started
+    return {'rows': rows, 'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds else None}
+
+
+#### Incremental reprocessing ####
+# Строки, которые не изменились с прошлого запуска, не пересчитываются.
+# Example:
+# result, stats = process_incremental(data, process, 'model.cache',
+#                                     version=config_version(mappers))
+# process получает только новые/измененные строки и должен сохранять
+# индекс исходных строк (строка может превратиться в несколько).
+# Если process сбрасывает индекс (split_rows, fix_agg_result, fix_val_type),
+# исходную строку нужно записать в колонку и передать ее как source_column:
+# process = lambda frame: split_rows(frame, 'Тип значения*', source_column='src')
+# result, stats = process_incremental(data, process, 'model.cache',
+#                                     source_column='src')
+
+
+ROW_HASH = '__row_hash__'
+
+
+# Хэш строки по исходным значениям. Значения не нормализуются: строка,
+# отличающаяся хотя бы пробелом, считается измененной и пересчитывается
+def row_hashes(data: pd.DataFrame, columns=None) -> pd.Series:
+    return pd.util.hash_pandas_object(data[list(columns or data.columns)],
+                                      index=False)
+
+
+# Приводит настройки к виду, который не зависит от порядка и типов ключей
+def _config_items(obj):
+    if isinstance(obj, dict):
+        return sorted(json.dumps([str(key), _config_items(value)],
+                                 ensure_ascii=False)
+                      for key, value in obj.items())
+    if isinstance(obj, (set, frozenset)):
+        return sorted(map(str, obj))
+    if isinstance(obj, (list, tuple)):
+        return [_config_items(item) for item in obj]
+    return str(obj)
+
+
+# Версия настроек (мапперы, справочники, правила): при ее смене кэш сбрасывается
+def config_version(*objects) -> str:
+    dump = json.dumps(_config_items(objects), ensure_ascii=False)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+# Версия функции обработки - по ее исходному коду. Если исходник недоступен
+# (функция определена в консоли), берется только имя, и при изменении
+# функции вызывающий должен сам поменять version в process_incremental
+def _function_version(function):
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        return getattr(function, '__qualname__', repr(function))
+
+
+class IncrementalCache:
+    '''Results of the previous run, one pickle file per datamodel'''
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, version):
+        try:
+            with open(self.path, 'rb') as f:
+                cached = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        if cached.get('version') != version:
+            return None
+        return cached['result']
+
+    def save(self, result, version):
+        temporal_name = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporal_name, 'wb') as f:
+            pickle.dump({'version': version, 'result': result}, f)
+        os.replace(temporal_name, self.path)
+
+
+# Пересчитывает только строки, хэша которых нет в кэше; результаты
+# для остальных берутся из прошлого запуска. Индекс data должен быть уникальным.
+# Возвращает результат и статистику: сколько строк взято из кэша и посчитано.
+# source_column - колонка результата process с индексом исходной строки
+def process_incremental(data: pd.DataFrame, process, cache, version='',
+                        source_column=None):
+    if not isinstance(cache, IncrementalCache):
+        cache = IncrementalCache(cache)
+    version = config_version(_function_version(process), version)
+    hashes = row_hashes(data)
+    previous = cache.load(version)
+    if previous is None:
+        changed = pd.Series(True, index=data.index)
+    else:
+        changed = ~hashes.isin(previous[ROW_HASH])
+    computed = process(data[changed])
+    if source_column:
+        computed = computed.set_index(source_column)
+        computed.index.name = data.index.name
+    if not computed.index.isin(data.index[changed]).all():
+        raise ValueError('process must keep the index of the source rows '
+                         '(or record it in source_column); got rows that do '
+                         'not come from the rows passed to it')
+    computed[ROW_HASH] = hashes.loc[computed.index].to_numpy()
+    parts = [computed]
+    if previous is not None and not changed.all():
+        unchanged = pd.DataFrame({ROW_HASH: hashes[~changed]})
+        reused = unchanged.rename_axis('__source__').reset_index() \
+                          .merge(previous, on=ROW_HASH, how='inner') \
+                          .set_index('__source__')
+        reused.index.name = data.index.name
+        parts.insert(0, reused)
+    result = pd.concat(parts)
+    position = pd.Series(np.arange(len(data)), index=data.index)
+    result = result.iloc[np.argsort(position.loc[result.index].to_numpy(),
+                                    kind='stable')]
+    # в кэш - результаты первой из одинаковых строк
+    if previous is None or changed.any():
+        first = data.index[~hashes.duplicated()]
+        cache.save(result[result.index.isin(first)].reset_index(drop=True),
+                   version)
+    stats = {'rows': len(data), 'reused': int((~changed).sum()),
+             'computed': int(changed.sum())}
+    return result.drop(columns=ROW_HASH), stats
+
+
 ### Class definition###
 
 
+# Колонки с небольшим числом различных значений, которые в compact-режиме
+# храним как category
+CATEGORICAL_COLUMNS = ['Единица измерения*', 'Дискретность*', 'Метрика*',
+                       'Тип значения*']
+
+
 class DataModel(DataFrame):
-    def __init__(self, data, column_mapper=COLUMN_MAPPER, columns=COLUMNS):
-        temp_data = data.rename(column_mapper)
-        super().__init__(columns = columns)
-        for i in self.columns:
-            self[i] = pd.Series(['']*len(data))
-        for i,j in column_mapper.items():
-            self[i] = data[j]
+    # Фрейм собирается за один раз без копий: смапленные колонки берутся из
+    # data как есть, а все пустые колонки ссылаются на один общий Series -
+    # при copy-on-write первая запись в колонку копирует только её.
+    # С compact=True смапленные колонки из CATEGORICAL_COLUMNS хранятся как
+    # category: памяти ещё меньше, но записать в них новое значение можно
+    # только после cat.add_categories, поэтому по умолчанию выключено
+    def __init__(self, data, column_mapper=COLUMN_MAPPER, columns=COLUMNS,
+                 compact=False):
+        filler = pd.Series(np.full(len(data), '', dtype=object),
+                           index=data.index, dtype=object)
+        frame = {}
+        for i in columns:
+            if i in column_mapper:
+                values = data[column_mapper[i]]
+                if compact and i in CATEGORICAL_COLUMNS:
+                    values = values.astype('category')
+                frame[i] = values
+            else:
+                frame[i] = filler
+        super().__init__(frame, index=data.index, columns=columns, copy=False)
+
+    # Сколько памяти занимает модель, байт. Общие объекты (строки, один
+    # filler на несколько колонок) считаются по одному разу, а не по ячейкам,
+    # как в memory_usage(deep=True)
+    def memory_footprint(self) -> int:
+        total = int(self.memory_usage(deep=False).sum())
+        buffers, objects = set(), []
+        for _, column in self.items():
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                total += int(column.cat.categories.memory_usage(deep=False))
+                values = column.cat.categories.to_numpy(dtype=object)
+            elif column.dtype == object or \
+                    getattr(column.dtype, 'storage', None) == 'python':
+                values = column.to_numpy(dtype=object)
+                # колонки над одним буфером уже посчитаны выше
+                buffer = values.__array_interface__['data'][0]
+                if buffer in buffers:
+                    total -= values.nbytes
+                    continue
+                buffers.add(buffer)
+            else:
+                continue
+            objects.append(values)
+        if objects:
+            values = np.concatenate(objects)
+            ids = np.fromiter(map(id, values), dtype=np.int64, count=len(values))
+            _, first = np.unique(ids, return_index=True)
+            total += sum(map(sys.getsizeof, values[first]))
+        return total
+
 # Дописать - чтобы шапка для импортера из верхних пяти строк была одинаковая
 
 # Поправить Тип на расчетный
@@ -356,6 +1339,7 @@ class DataModel(DataFrame):
 # НЕправильно, надо ставить тип в расчкте из метрик
     
 # Поправить некорректные символы в справочниках
+    @instrumented
     def filter_functional_and_territorial_dicts(self, 
                                                 orgstructure='Справочник показателей (территориальный)*', 
                                                 structure='Справочник показателей (функциональный)*'):
@@ -366,14 +1350,22 @@ class DataModel(DataFrame):
                                         structure: ['∑']},
                                         value='Сумма')
 
+# Проверить колонки по эталонным справочникам, см. validate_columns
+    def validate(self, references, filename=None, **kvargs):
+        return validate_columns(self, references, filename, **kvargs)
+
 # Записать уникальные наборы значений в колонках    
     def write_sets_of_columns(self, 
                               column_set=['Единица измерения*', 'Дискретность*', 'Метрика*', 'Тип значения*'],
-                              dictionary_folder="./skim_N_sets/"):
+                              dictionary_folder="./skim_N_sets/",
+                              store=None):
         for column in column_set:
             column_values = get_set_attribute(self, 
                                               column)
             column_dictionary = {i: i for i in column_values}
+            if store is not None:
+                store.merge(column, column_dictionary)
+                continue
             temporal_name = re.sub(r'\W+', '', column)
             filename = dictionary_folder + temporal_name + ".yaml"
             print(column)
@@ -398,7 +1390,171 @@ class DataModel(DataFrame):
     # target_dm[new_column_name] = new_column
 
 
-# Актуально для СКИМ Н - поправить типы значений, записанные в формате "Итог, нарастающий итог по месяцам/суткам/неделям с начала месяца"
-#    def fix_val_type(self, 
-#                     valtype_column='Тип значения*'):
-#        return fix_agg_result(split_rows_by_comma(self, 'Тип значения*'), 'Тип значения*')
\ No newline at end of file
+    # Актуально для СКИМ Н - поправить типы значений, записанные в формате "Итог, нарастающий итог по месяцам/суткам/неделям с начала месяца"
+    @instrumented
+    def fix_val_type(self, 
+                     valtype_column='Тип значения*'):
+        return fix_agg_result(split_rows(self, valtype_column, strip=True),
+                              valtype_column)
+
+
+#### Batch conversion ####
+# Example:
+# report = convert_folder('./source/', './converted/',
+#                         mappers=MappingStore('skim_mappings.sqlite'),
+#                         references={'Метрика*': 'metrics.csv'})
+# or from the command line:
+# python skimtools.py ./source/ ./converted/ --mappings skim_mappings.sqlite
+
+
+# Мапперы и справочники загружаются один раз в родительском процессе
+# и передаются каждому процессу при запуске
+_WORKER_CONTEXT = {}
+
+def _init_worker(mappers, references, profile=None):
+    _WORKER_CONTEXT['mappers'] = mappers
+    _WORKER_CONTEXT['references'] = references
+    _WORKER_CONTEXT['profile'] = profile
+
+
+# Путь к MappingStore должен существовать: sqlite3.connect молча создал бы
+# пустую базу, и весь пакет сконвертировался бы без мапперов
+def _load_mappers(mappers, version='current'):
+    if isinstance(mappers, str):
+        if not os.path.isfile(mappers):
+            raise FileNotFoundError(f'MappingStore not found: {mappers}')
+        store = MappingStore(mappers)
+        try:
+            return _load_mappers(store, version)
+        finally:
+            store.close()
+    if isinstance(mappers, MappingStore):
+        return {column: mappers.get(column, version)
+                for column in mappers.columns(version)}
+    return {column: read_yaml(mapper) if isinstance(mapper, str) else mapper
+            for column, mapper in (mappers or {}).items()}
+
+
+def _load_references(references):
+    return {column: read_reference(reference)
+            if isinstance(reference, str) else frozenset(reference)
+            for column, reference in (references or {}).items()}
+
+
+# Полный цикл для одного файла:
+# guess_params -> open_md -> DataModel -> correct_column -> export_md
+# С cache (путь к файлу кэша) пересчитываются только измененные строки
+def convert_md(filename, output, mappers=None, references=None,
+               encoding='utf-8-sig', cache=None) -> dict:
+    def process(source):
+        data = DataModel(source)
+        for column, mapper in (mappers or {}).items():
+            data[column] = correct_column(data, column, '', mapper)
+        return data
+
+    started = time.perf_counter()
+    stats = {}
+    with profile_file(filename):
+        source = open_md(filename, autodetect=True)
+        if cache:
+            data, stats = process_incremental(source, process, cache,
+                                              config_version(mappers))
+        else:
+            data = process(source)
+        invalid = validate_columns(data, references) if references else None
+        export_md(data, output, encoding=encoding)
+    return {'rows': len(data),
+            'invalid': 0 if invalid is None else int(invalid['count'].sum()),
+            'reused': stats.get('reused'),
+            'seconds': time.perf_counter() - started}
+
+
+def _convert_task(task):
+    filename, output, encoding, cache = task
+    profile = _WORKER_CONTEXT.get('profile')
+    profiler = Profiler(run=profile) if profile else contextlib.nullcontext()
+    try:
+        with profiler:
+            result = convert_md(filename, output,
+                                _WORKER_CONTEXT.get('mappers'),
+                                _WORKER_CONTEXT.get('references'),
+                                encoding,
+                                cache)
+        report = {'file': filename, 'output': output, 'status': 'ok',
+                  'error': None, **result}
+    except Exception as error:
+        report = {'file': filename, 'output': output, 'status': 'failed',
+                  'error': f'{type(error).__name__}: {error}'}
+    if profile:
+        report['stages'] = profiler.records
+    return report
+
+
+# Конвертирует все модели данных из папки source в папку destination
+# пулом процессов. Ошибка в одном файле не останавливает остальные,
+# итог по каждому файлу возвращается таблицей.
+# С profile=True в колонке stages - замеры стадий по каждому файлу (см. Profiler),
+# все вместе: pd.DataFrame([r for stages in report.stages for r in stages])
+# С cache_folder неизменившиеся строки берутся из результатов прошлого запуска
+def convert_folder(source, destination, mappers=None, references=None,
+                   workers=None, pattern='*.csv',
+                   encoding='utf-8-sig', profile=False,
+                   cache_folder=None) -> pd.DataFrame:
+    os.makedirs(destination, exist_ok=True)
+    if cache_folder:
+        os.makedirs(cache_folder, exist_ok=True)
+    tasks = [(filename,
+              os.path.join(destination, os.path.basename(filename)),
+              encoding,
+              os.path.join(cache_folder, os.path.basename(filename) + '.cache')
+              if cache_folder else None)
+             for filename in sorted(glob.glob(os.path.join(source, pattern)))]
+    run = time.strftime('%Y-%m-%d %H:%M:%S') if profile else None
+    context = (_load_mappers(mappers), _load_references(references), run)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=context) as executor:
+        results = list(executor.map(_convert_task, tasks))
+    columns = ['file', 'output', 'status', 'rows', 'invalid', 'reused',
+               'seconds', 'error']
+    if profile:
+        columns.append('stages')
+    return pd.DataFrame(results, columns=columns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a folder of SKIM datamodels for the importer')
+    parser.add_argument('source', help='folder with source datamodels')
+    parser.add_argument('destination', help='folder for converted datamodels')
+    parser.add_argument('--mappings', help='MappingStore file with column mappers')
+    parser.add_argument('--reference', action='append', default=[],
+                        metavar='COLUMN=FILE',
+                        help='reference dictionary (csv) for a column')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--pattern', default='*.csv')
+    parser.add_argument('--encoding', default='utf-8-sig')
+    parser.add_argument('--cache', metavar='FOLDER',
+                        help='reuse unchanged rows from the previous run')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write per-stage timings of every file to FILE (json)')
+    args = parser.parse_args(argv)
+    references = dict(item.split('=', 1) for item in args.reference)
+    report = convert_folder(args.source, args.destination,
+                            mappers=args.mappings,
+                            references=references,
+                            workers=args.workers,
+                            pattern=args.pattern,
+                            encoding=args.encoding,
+                            profile=bool(args.profile),
+                            cache_folder=args.cache)
+    if args.profile:
+        stages = pd.DataFrame([record for stages in report.pop('stages')
+                               for record in stages])
+        stages.to_json(args.profile, orient='records', force_ascii=False)
+    print(report.to_string(index=False))
+    return 0 if (report.status == 'ok').all() else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,330 @@
+""" Synthetic SKIM datamodels and benchmarks for skimtools
+
+    python skimtools_bench.py --sizes 1000 10000 --label before
+    python skimtools_bench.py --compare bench_results/before.json bench_results/after.json
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import skimtools as st
+
+
+#### Synthetic datamodels ####
+
+
+WORDS = ['объем', 'перевозки', 'грузов', 'пассажиров', 'вагонов', 'локомотивов',
+         'доля', 'отклонение', 'выручка', 'расходы', 'численность', 'персонала',
+         'погрузка', 'оборот', 'простой', 'скорость', 'участковая', 'техническая',
+         'ремонт', 'пути', 'энергии', 'топлива', 'дирекция', 'дорога']
+UNITS = ['тыс. т', 'млн. руб.', 'ваг.', 'чел.', 'км/ч', '%', 'ед.', 'тыс. ткм']
+PERIODS = ['сутки', 'месяц', 'квартал', 'год', 'неделя']
+METRICS = ['Факт', 'План', 'Ожидаемый факт',
+           'Относительное отклонение (скорректировать)',
+           'Абсолютное отклонение (скорректировать)']
+VALUE_TYPES = ['Итог', 'Нарастающий итог', 'Среднее',
+               'Итог, нарастающий итог по месяцам/суткам/неделям',
+               'Итог по суткам/неделям', 'Итог, среднее']
+SOURCES = ['АС ЭТРАН', 'АСОУП', 'ЕК АСУФР', 'ЕК АСУТР', 'АС ЦКИ']
+DATA_TYPES = ['ожидаемый', 'утвержденный', 'оперативный', 'статистический',
+              'расследованный', 'прочий']
+
+
+# Опечатка: пропуск, замена или перестановка символа
+def _typo(value, rng):
+    if len(value) < 3:
+        return value
+    position = rng.randrange(len(value) - 1)
+    kind = rng.randrange(3)
+    if kind == 0:
+        return value[:position] + value[position + 1:]
+    if kind == 1:
+        return value[:position] + rng.choice('абвгдеиклмнопрст') + value[position + 1:]
+    return value[:position] + value[position + 1] + value[position] + value[position + 2:]
+
+
+def _phrases(count, rng, words=3):
+    return [' '.join(rng.choice(WORDS) for _ in range(words)) + f' {i}'
+            for i in range(count)]
+
+
+# Эталонные значения колонок, из которых собирается модель
+def make_reference(cardinality=200, seed=0) -> dict:
+    rng = random.Random(seed)
+    return {
+        'ПОКАЗАТЕЛЬ': [rng.choice(['Доля ', 'Отклонение ', '']) + phrase
+                       for phrase in _phrases(cardinality, rng, 4)],
+        'НАИМЕНОВАНИЕ ФОРМЫ': _phrases(max(1, cardinality // 10), rng),
+        'ЕД.ИЗМЕРЕНИЯ': UNITS,
+        'ТИП ОТЧЕТНОГО ПЕРИОДА': PERIODS,
+        'ВЕРСИЯ ДАННЫХ': METRICS,
+        'ТИП ЗНАЧЕНИЯ': VALUE_TYPES,
+        'НОРМАТИВНЫЙ ДОКУМЕНТ': [f'Распоряжение № {i}р от 01.0{i % 9 + 1}.2020'
+                                 for i in range(max(1, cardinality // 10))],
+        'ИСТОЧНИК МАСТЕР-ДАННЫХ': SOURCES,
+        'КОММЕНТАРИИ': [f'{phrase} {rng.choice(DATA_TYPES)}'
+                        for phrase in _phrases(max(1, cardinality // 5), rng)],
+        'ФИЛИАЛ': [f'Филиал {phrase}' for phrase in _phrases(20, rng, 1)],
+        'ОТВЕТСТВЕННЫЙ НАЧАЛЬНИК ФИЛИАЛА': [f'Начальник {i}' for i in range(20)],
+        'ФОРМА СТАТИСТИЧЕСКОЙ ОТЧЕТНОСТИ': [
+            f'ЦО-{i} {phrase}' if i % 3 else f'справка №{i}'
+            for i, phrase in enumerate(_phrases(max(1, cardinality // 10), rng))],
+        'РЕГЛАМЕНТ ФОРМИРОВАНИЯ ПОКАЗАТЕЛЕЙ': _phrases(max(1, cardinality // 10), rng),
+        'ОРГСТРУКТУРА': ['ОАО «РЖД»\nдорога', 'Дирекция\tтяги', 'Сеть', '\n'],
+        'СТРУКТУРА': ['Перевозки', 'Инфраструктура', '\t', 'Сумма по сети'],
+    }
+
+
+# Синтетическая исходная модель данных (колонки - значения COLUMN_MAPPER).
+# noise - доля значений с опечатками, cardinality - число различных показателей
+def make_datamodel(rows=1000, cardinality=200, noise=0.05, seed=0) -> pd.DataFrame:
+    rng = random.Random(seed)
+    reference = make_reference(cardinality, seed)
+    data = {}
+    for column, values in reference.items():
+        column_values = rng.choices(values, k=rows)
+        if noise and column in ('ПОКАЗАТЕЛЬ', 'ЕД.ИЗМЕРЕНИЯ', 'ВЕРСИЯ ДАННЫХ'):
+            column_values = [_typo(value, rng) if rng.random() < noise else value
+                             for value in column_values]
+        data[column] = column_values
+    data['VAR'] = [f'v{rng.randrange(10 ** 6)}' + rng.choice(['_fp', '_ff', '_afp', '_aff', ''])
+                   for _ in range(rows)]
+    return pd.DataFrame(data)
+
+
+# variant: 'utf-8' (запятая) или 'cp1251' (точка с запятой)
+def write_datamodel(data, filename, variant='utf-8'):
+    if variant == 'cp1251':
+        data.to_csv(filename, sep=';', encoding='cp1251', index=False)
+    else:
+        data.to_csv(filename, encoding='utf-8', index=False)
+    return filename
+
+
+#### Benchmarks ####
+
+
+def _reset_caches():
+    st._MATCHERS.clear()
+    st._REFERENCES.clear()
+    st._CLASSIFIED.clear()
+    gc.collect()
+
+
+UNIT_MAPPER = {unit: unit.upper() for unit in UNITS}
+
+
+# Каждый случай: setup(окружение) -> аргументы, затем функция(*аргументы).
+# setup вызывается перед каждым замером, поэтому случаи, которые меняют
+# свои аргументы или хранилище мапперов, каждый раз начинают с одного состояния
+def _cases():
+    def model(env):
+        return env['model'].copy()
+
+    # В хранилище - маппер единиц измерения и половина известных показателей
+    def store(env):
+        env['store'].delete('Наименование*')
+        names = st.get_set_attribute(env['model'], 'Наименование*')
+        env['store'].merge('Наименование*', {i: i for i in names[::2]})
+        env['store'].update('Единица измерения*', UNIT_MAPPER)
+        env['store']._cache.clear()
+        return env['store']
+
+    # Кэш заполнен прошлым запуском, в новой версии изменен 1% строк
+    def incremental(env):
+        cache = env['csv'] + '.incremental'
+        st.process_incremental(env['source'], _incremental_process, cache)
+        edited = env['source'].copy()
+        edited.iloc[::100, 0] = 'измененный показатель'
+        return edited, _incremental_process, cache
+
+    def pipeline(env):
+        chunks = st.open_md(env['csv'], sep=';', encoding='cp1251', chunksize=100_000)
+        return (st.run_pipeline(chunks,
+                                st.stage(st.DataModel),
+                                st.correct_stage({'Единица измерения*': UNIT_MAPPER}),
+                                st.map_stage('Наименование*', st.define_type,
+                                             target='Тип*')),
+                env['csv'] + '.pipeline.csv')
+
+    return {
+        'sniff_params': (lambda env: (env['csv'],), st.sniff_params),
+        'guess_params': (lambda env: (env['csv'],),
+                         lambda filename: st.guess_params(filename, cache=None)),
+        'open_md': (lambda env: (env['csv'],),
+                    lambda filename: st.open_md(filename, sep=';', encoding='cp1251')),
+        'open_md[chunksize]': (lambda env: (env['csv'],),
+                               lambda filename: sum(len(chunk) for chunk in st.open_md(
+                                   filename, sep=';', encoding='cp1251', chunksize=100_000))),
+        'DataModel': (lambda env: (env['source'],), st.DataModel),
+        'DataModel[compact=True]': (lambda env: (env['source'],),
+                                    lambda source: st.DataModel(source, compact=True)),
+        'DataModel.memory_footprint': (lambda env: (env['model'],),
+                                       st.DataModel.memory_footprint),
+        'get_set_attribute': (lambda env: (env['model'], 'Наименование*'),
+                              st.get_set_attribute),
+        'map_attribute': (lambda env: (st.get_set_attribute(env['model'], 'Наименование*'),
+                                       env['reference']['ПОКАЗАТЕЛЬ']),
+                          st.map_attribute),
+        'mapper': (lambda env: (env['model'], 'Единица измерения*',
+                                env['reference']['ЕД.ИЗМЕРЕНИЯ']),
+                   st.mapper),
+        'FuzzyMatcher.match_many': (lambda env: (st.FuzzyMatcher(env['reference']['ПОКАЗАТЕЛЬ']),
+                                                 st.get_set_attribute(env['model'], 'Наименование*'),
+                                                 3),
+                                    st.FuzzyMatcher.match_many),
+        'correct_column': (lambda env: (env['model'], 'Единица измерения*', '',
+                                        UNIT_MAPPER),
+                           st.correct_column),
+        'correct_columns[store]': (lambda env: (model(env), ['Единица измерения*'],
+                                                store(env)),
+                                   st.correct_columns),
+        'write_sets[store]': (lambda env: (env['model'], ['Наименование*'], True, None,
+                                           0.6, store(env)),
+                              st.write_sets),
+        'split_rows_by_comma': (lambda env: (env['model'], 'Тип значения*'),
+                                st.split_rows_by_comma),
+        'fix_agg_result': (lambda env: (st.split_rows(env['model'], 'Тип значения*',
+                                                      strip=True), 'Тип значения*'),
+                           st.fix_agg_result),
+        'DataModel.fix_val_type': (lambda env: (env['model'],), st.DataModel.fix_val_type),
+        'DataModel.filter_functional_and_territorial_dicts': (
+            lambda env: (env['model'],),
+            st.DataModel.filter_functional_and_territorial_dicts),
+        'fixing_deviations_based_on_var': (
+            lambda env: (model(env).assign(VAR=env['source']['VAR']), 'VAR', 'Метрика*'),
+            st.fixing_deviations_based_on_var),
+        'dictionary_check': (lambda env: (env['model'], 'Метрика*', env['metrics_csv']),
+                             st.dictionary_check),
+        'DataModel.validate': (lambda env: (env['model'], {
+                                   'Метрика*': env['metrics_csv'],
+                                   'Единица измерения*': set(UNITS)}),
+                               st.DataModel.validate),
+        'get_invalid_metrics': (lambda env: (env['model'], frozenset(METRICS)),
+                                st.get_invalid_metrics),
+        'define_type': (lambda env: (env['model']['Наименование*'],),
+                        lambda values: values.map(st.define_type)),
+        'define_type_column': (lambda env: (env['model']['Наименование*'],),
+                               st.define_type_column),
+        'extract_dt': (lambda env: (env['model']['Алгоритм расчёта*'],),
+                       lambda values: values.map(st.extract_dt)),
+        'extract_dt_column': (lambda env: (env['model']['Алгоритм расчёта*'],),
+                              st.extract_dt_column),
+        'get_form_names': (lambda env: (env['model']['Индекс/код и наименование формы отчётности*'],),
+                           lambda values: values.map(st.get_form_names)),
+        'get_form_names_column': (lambda env: (env['model']['Индекс/код и наименование формы отчётности*'],),
+                                  st.get_form_names_column),
+        'add_header': (lambda env: (env['model'],), st.add_header),
+        'export_md': (lambda env: (env['model'], env['csv'] + '.export.csv'),
+                      st.export_md),
+        'run_pipeline+write_chunks': (pipeline, st.write_chunks),
+        'convert_md': (lambda env: (env['csv'], env['csv'] + '.converted.csv',
+                                    {'Единица измерения*': UNIT_MAPPER},
+                                    {'Метрика*': frozenset(METRICS)}),
+                       st.convert_md),
+        'row_hashes': (lambda env: (env['source'],), st.row_hashes),
+        'process_incremental': (incremental, st.process_incremental),
+    }
+
+
+def _incremental_process(frame):
+    data = st.DataModel(frame)
+    data['Единица измерения*'] = st.correct_column(data, 'Единица измерения*', '',
+                                                   UNIT_MAPPER)
+    return data
+
+
+# Вывод самих функций (print) в замеры не попадает
+def _measure(function, setup, env, repeat):
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            args = setup(env)
+            _reset_caches()
+            started = time.perf_counter()
+            function(*args)
+            seconds.append(time.perf_counter() - started)
+        args = setup(env)
+        _reset_caches()
+        tracemalloc.start()
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return min(seconds), peak / 2 ** 20
+
+
+# Замеры времени (лучшее из repeat) и пикового прироста памяти
+# для каждого случая и размера модели
+def run_benchmarks(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6), cases=None,
+                   repeat=3, cardinality=200, noise=0.05) -> pd.DataFrame:
+    selected = {name: case for name, case in _cases().items()
+                if cases is None or name in cases}
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        metrics_csv = os.path.join(folder, 'metrics.csv')
+        pd.DataFrame({'NAME': METRICS[:3]}).to_csv(metrics_csv, sep=';', index=False)
+        for rows in sizes:
+            source = make_datamodel(rows, cardinality, noise)
+            env = {'source': source,
+                   'model': st.DataModel(source),
+                   'reference': make_reference(cardinality),
+                   'csv': write_datamodel(source, os.path.join(folder, f'{rows}.csv'),
+                                          'cp1251'),
+                   'metrics_csv': metrics_csv,
+                   'store': st.MappingStore(os.path.join(folder, f'{rows}.sqlite'))}
+            for name, (setup, function) in selected.items():
+                seconds, peak = _measure(function, setup, env, repeat)
+                results.append({'case': name, 'rows': rows,
+                                'seconds': seconds, 'peak_mb': peak})
+                print(f'{name:55} {rows:>8} {seconds:10.4f} s {peak:10.1f} MB')
+            env['store'].close()
+    return pd.DataFrame(results)
+
+
+def save_results(results, label, folder='bench_results'):
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, f'{label}.json')
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(results.to_dict('records'), f, ensure_ascii=False, indent=1)
+    return filename
+
+
+# Сравнение двух прогонов: отношение времени и памяти (new / old)
+def compare_results(old_filename, new_filename) -> pd.DataFrame:
+    old = pd.read_json(old_filename)
+    new = pd.read_json(new_filename)
+    merged = old.merge(new, on=['case', 'rows'], suffixes=('_old', '_new'))
+    merged['time_ratio'] = merged.seconds_new / merged.seconds_old
+    merged['memory_ratio'] = merged.peak_mb_new / merged.peak_mb_old
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='skimtools benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6])
+    parser.add_argument('--cases', nargs='+', default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--label', default=time.strftime('%Y%m%d-%H%M%S'))
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args(argv)
+    if args.compare:
+        print(compare_results(*args.compare).to_string(index=False))
+        return 0
+    results = run_benchmarks(args.sizes, args.cases, args.repeat)
+    print('saved to', save_results(results, args.label))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())